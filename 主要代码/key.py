@@ -3,6 +3,9 @@ import sensor
 import image
 import time
 import pyb
+import sys
+import micropython
+import array
 
 # ====================================================================
 # --- 第1部分：按键映射数据（请替换为实际校准数据）---
@@ -19,6 +22,7 @@ keymap_data = [
     {'center': (62, 113), 'rect': (57,104,30, 30), 'key': '-'},
     {'center': (222, 99), 'rect': (217, 90, 10, 17), 'key': 'BACK'},
     ]
+CALIB_W, CALIB_H = 320, 240     # 以上数据校准时的图像尺寸（QVGA）
 
 # ====================================================================
 # --- 第2部分：主程序逻辑（优化版）---
@@ -26,28 +30,93 @@ keymap_data = [
 
 # --- 配置参数 ---
 BLOB_THRESHOLD = (10, 255)       # 红外斑点阈值（根据实际环境调整）
-DEBOUNCE_TIME = 200             # 按键去抖时间(ms)
-MIN_BLOB_PIXELS = 50            # 最小斑点像素数
-COORD_PRINT_INTERVAL = 2000     # 坐标打印间隔(ms)
+DEBOUNCE_FRAMES = 2             # 按键去抖：连续确认帧数
+CALIB_MIN_BLOB_PIXELS = 50      # 校准尺寸下的最小斑点像素数（按追踪分辨率自动换算）
+COORD_PRINT_FRAMES = 60         # 坐标打印间隔(帧数，实际时长随帧率变化)
+IDLE_SLEEP_MS = 20              # 无斑点时的空闲休眠(ms)
 
 # --- 初始化摄像头 ---
 sensor.reset()
 sensor.set_pixformat(sensor.GRAYSCALE)
-sensor.set_framesize(sensor.QVGA)  # 320x240分辨率
+sensor.set_framesize(sensor.QQVGA)  # 160x120分辨率
 sensor.skip_frames(time=2000)      # 等待设置生效
 # 固定曝光和增益以提高识别稳定性
 sensor.set_auto_gain(False, gain_db=12)
 sensor.set_auto_exposure(False, exposure_us=1200)
 
+# --- 预计算像素->按键查找表（LUT）---
+# 每个像素存放命中的按键索引，0xFF表示不在任何按键内。
+# 倒序填充，使列表中靠前的按键覆盖靠后的按键（与原先"先匹配先生效"一致）；
+# 只填充矩形内部像素，保持原先严格不等式的判定边界。
+# 映射数据按 CALIB_W x CALIB_H 的图像校准；帧尺寸取自 set_framesize 的实际结果，
+# 加载时坐标除以 KEYMAP_SCALE 换算到追踪分辨率（只支持宽高同比例的整数倍缩小）
+IMG_W, IMG_H = sensor.width(), sensor.height()
+assert (IMG_W <= CALIB_W and CALIB_W % IMG_W == 0 and CALIB_H % IMG_H == 0 and
+        CALIB_W // IMG_W == CALIB_H // IMG_H), "帧尺寸必须是校准尺寸的整数倍缩小"
+KEYMAP_SCALE = CALIB_W // IMG_W
+# 斑点面积随缩放比例的平方缩小（QQVGA 下为 50 // 4 = 12）
+MIN_BLOB_PIXELS = CALIB_MIN_BLOB_PIXELS // (KEYMAP_SCALE * KEYMAP_SCALE)
+# 按键数据转为并行元组（结构数组），避免运行时的字典查找
+keys = tuple(k['key'] for k in keymap_data)
+# 中心坐标只用于打印/显示，保持校准时的 QVGA 坐标，便于对照校准数据
+centers = tuple(k['center'] for k in keymap_data)
+rects = tuple(tuple(v // KEYMAP_SCALE for v in k['rect']) for k in keymap_data)
+key_x0 = tuple(r[0] for r in rects)
+key_y0 = tuple(r[1] for r in rects)
+key_x1 = tuple(r[0] + r[2] for r in rects)
+key_y1 = tuple(r[1] + r[3] for r in rects)
+
+# 所有按键矩形的外接框（限制在图像范围内）：框外的坐标直接判定为未命中
+BB_X0 = max(min(key_x0), 0)
+BB_Y0 = max(min(key_y0), 0)
+BB_X1 = min(max(key_x1), IMG_W)
+BB_Y1 = min(max(key_y1), IMG_H)
+LUT_W = BB_X1 - BB_X0
+LUT_H = BB_Y1 - BB_Y0
+
+# 查找表只覆盖外接框，坐标需减去 (BB_X0, BB_Y0)
+key_lut = bytearray(b'\xff' * (LUT_W * LUT_H))
+for i in range(len(keys) - 1, -1, -1):
+    xs, xe = max(key_x0[i] + 1, BB_X0), min(key_x1[i], BB_X1)
+    if xs >= xe:
+        continue
+    row = bytes([i]) * (xe - xs)
+    for yy in range(max(key_y0[i] + 1, BB_Y0), min(key_y1[i], BB_Y1)):
+        base = (yy - BB_Y0) * LUT_W - BB_X0
+        key_lut[base + xs:base + xe] = row
+
+# 外接框参数，供 viper 函数以 ptr16 读取：(x0, y0, 宽, 高)
+key_geom = array.array('H', (BB_X0, BB_Y0, LUT_W, LUT_H))
+
+
+@micropython.viper
+def hit_test(cx: int, cy: int, lut: ptr8, geom: ptr16) -> int:
+    # 编译为本地机器码：外接框检查 + 查表，返回按键索引，0xFF 表示未命中
+    x = cx - geom[0]
+    y = cy - geom[1]
+    w = geom[2]
+    if x < 0 or y < 0 or x >= w or y >= geom[3]:
+        return 0xFF
+    return lut[y * w + x]
+
+# --- 斑点检测区域：同一外接框 ---
+KEYMAP_ROI = (BB_X0, BB_Y0, LUT_W, LUT_H)
+
+# --- 预编码串口指令（避免主循环中格式化字符串）---
+press_cmds = {k: ('D_' + k + '\n').encode() for k in keys}
+release_cmds = {k: ('U_' + k + '\n').encode() for k in keys}
+
+# --- 按住状态下的快速检测：按键名 -> 索引 ---
+key_index = {k: i for i, k in enumerate(keys)}
+# 矩形内部（去掉边界一圈）须能容纳边长为 sqrt(MIN_BLOB_PIXELS) 的方形斑点，否则手指斑点
+# 几乎总会触边，快速检测必然失败而多扫一次；这类过小的按键（如 BACK）直接走整帧检测
+can_shortcut = tuple(max(min(r[2], r[3]) - 2, 0) ** 2 >= MIN_BLOB_PIXELS for r in rects)
+
 # --- 初始化串口（根据Vision Board实际串口调整）---
 # 假设使用UART2，波特率115200
 uart_to_mcu = pyb.UART(9, 115200)
 
-# --- 状态变量 ---
-last_pressed_key = None          # 上一次按下的按键
-last_key_time = 0                # 上次按键时间（去抖用）
-last_center_coords = None        # 上一次识别的中心坐标
-last_print_time = 0              # 上次打印坐标的时间
+# --- 硬件与调试 ---
 led_blue = pyb.LED(3)            # 蓝色LED指示灯
 debug_mode = True                # 调试模式开关
 
@@ -58,98 +127,185 @@ print("--- Vision Keyboard System Started ---")
 print(f"Keymap loaded: {len(keymap_data)} keys")
 print("Waiting for input...")
 
-# --- 主循环 ---
-while True:
-    clock.tick()
-    img = sensor.snapshot()
-
-    # 查找红外斑点
-    blobs = img.find_blobs([BLOB_THRESHOLD],
-                          pixels_threshold=MIN_BLOB_PIXELS,
-                          area_threshold=MIN_BLOB_PIXELS,
-                          merge=True)
-
-    current_key_found = None
-    current_center_coords = None  # 当前识别区域的中心坐标
-    main_blob = None
-
-    if blobs:
-        # 选择最大的斑点
-        main_blob = max(blobs, key=lambda b: b.pixels())
-        cx, cy = main_blob.cx(), main_blob.cy()
-
-        # 绘制斑点调试信息
-        img.draw_rectangle(main_blob.rect(), color=128)
-        img.draw_cross(cx, cy, color=128)
-
-        # 检测按键映射
-        for key_info in keymap_data:
-            rect = key_info["rect"]
-            key = key_info["key"]
-            center = key_info["center"]  # 获取该区域的中心坐标
-
-            if (cx > rect[0] and cx < rect[0] + rect[2] and
-                cy > rect[1] and cy < rect[1] + rect[3]):
-
-                if key != "NULL":
-                    current_key_found = key
-                    current_center_coords = center  # 记录当前识别区域的中心坐标
+
+def main():
+    # 循环中频繁使用的全局对象/方法绑定为局部变量（局部变量访问比全局字典查找快）
+    snapshot = sensor.snapshot
+    tick = clock.tick
+    write = uart_to_mcu.write
+    out = sys.stdout.write
+    lut = key_lut
+    key_names = keys
+    key_centers = centers
+    thresholds = [BLOB_THRESHOLD]
+    roi = KEYMAP_ROI
+    find_key = hit_test
+    geom = key_geom
+    key_rects = rects
+    index_of = key_index
+    shortcut_ok = can_shortcut
+    press = press_cmds
+    release = release_cmds
+    led_on = led_blue.on
+    led_off = led_blue.off
+    get_fps = clock.fps
+    sleep_ms = time.sleep_ms
+    min_pixels = MIN_BLOB_PIXELS
+    idle_ms = IDLE_SLEEP_MS
+    debounce_frames = DEBOUNCE_FRAMES
+    print_frames = COORD_PRINT_FRAMES
+    debug = debug_mode
+
+    # --- 状态变量 ---
+    last_pressed_key = None          # 上一次按下的按键
+    candidate_key = None             # 候选按键（去抖用）
+    candidate_count = 0              # 候选按键连续出现的帧数
+    last_center_coords = None        # 上一次识别的中心坐标
+    frame_ctr = 0                    # 距上次打印坐标的帧数
+    shown_fps = -1                   # 调试文字缓存对应的FPS（取整）
+    shown_key = None                 # 调试文字缓存对应的按键
+    shown_center = None              # 调试文字缓存对应的中心坐标
+    debug_info = ""                  # 缓存的调试文字
+
+    # --- 主循环 ---
+    while True:
+        tick()
+        img = snapshot()
+
+        current_key_found = None
+        current_center_coords = None  # 当前识别区域的中心坐标
+        main_blob = None
+        blobs = None
+
+        # 已有按键按住时，先只在该按键矩形内按与按下相同的条件查找斑点：
+        # 仅有一个斑点、完全位于矩形内部（未被矩形边界截断）且质心仍映射到该按键时，
+        # 视为继续按住并跳过整帧斑点检测；否则回退到整帧检测（处理释放和换键）
+        held = False
+        if last_pressed_key is not None:
+            held_idx = index_of[last_pressed_key]
+            if shortcut_ok[held_idx]:
+                hx, hy, hw, hh = key_rects[held_idx]
+                held_blobs = img.find_blobs(thresholds,
+                                            roi=key_rects[held_idx],
+                                            pixels_threshold=min_pixels,
+                                            area_threshold=min_pixels)
+                if len(held_blobs) == 1:
+                    hb = held_blobs[0]
+                    bx, by, bw, bh = hb.rect()
+                    held = (bx > hx and by > hy and bx + bw < hx + hw and by + bh < hy + hh and
+                            find_key(hb.cx(), hb.cy(), lut, geom) == held_idx)
+
+        if held:
+            current_key_found = last_pressed_key
+            current_center_coords = key_centers[held_idx]
+            if debug:
+                img.draw_rectangle(key_rects[held_idx], color=255, thickness=2)
+        else:
+            # 查找红外斑点（只跟踪最大的斑点，不需要 merge 合并）
+            # 只在按键区域内查找，cx/cy 仍为整幅图像坐标
+            blobs = img.find_blobs(thresholds,
+                                  roi=roi,
+                                  pixels_threshold=min_pixels,
+                                  area_threshold=min_pixels)
+
+            if blobs:
+                # 选择最大的斑点（通常只有一个斑点，直接取用）
+                main_blob = blobs[0]
+                if len(blobs) > 1:
+                    best = main_blob.pixels()
+                    for b in blobs[1:]:
+                        p = b.pixels()
+                        if p > best:
+                            best = p
+                            main_blob = b
+                cx = main_blob.cx()
+                cy = main_blob.cy()
+
+                # 绘制斑点调试信息
+                if debug:
+                    rect_bb = main_blob.rect()
+                    img.draw_rectangle(rect_bb, color=128)
+                    img.draw_cross(cx, cy, color=128)
+
+                # 外接框检查与查表在 viper 本地代码中完成
+                idx = find_key(cx, cy, lut, geom)
+                if idx != 0xFF and key_names[idx] != "NULL":
+                    current_key_found = key_names[idx]
+                    current_center_coords = key_centers[idx]  # 记录当前识别区域的中心坐标
                     # 高亮显示当前按键
-                    img.draw_rectangle(rect, color=255, thickness=2)
-                break
-
-    # 更新当前中心坐标（即使未识别到按键也更新）
-    if blobs and current_center_coords:
-        last_center_coords = current_center_coords
-    elif not blobs:
-        last_center_coords = None  # 没有检测到斑点时，中心坐标为None
-
-    # --- 按键状态机（带去抖处理）---
-    current_time = time.ticks_ms()
-    if current_key_found != last_pressed_key or (current_key_found and last_pressed_key):
-        # 去抖检查
-        if current_key_found and time.ticks_diff(current_time, last_key_time) < DEBOUNCE_TIME:
-            current_key_found = None
-
-        if current_key_found != last_pressed_key:
-            # 按键状态变化时更新LED
-            led_blue.on() if current_key_found else led_blue.off()
-
-            # 发送按键释放命令
-            if last_pressed_key:
-                release_cmd = f"U_{last_pressed_key}\n"
-                uart_to_mcu.write(release_cmd)
-                if debug_mode:
-                    print(f"[RELEASE] {last_pressed_key}")
-
-            # 发送按键按下命令并打印中心坐标
-            if current_key_found:
-                press_cmd = f"D_{current_key_found}\n"
-                uart_to_mcu.write(press_cmd)
-                if debug_mode:
-                    print(f"[PRESS] {current_key_found}")
-                    # 打印识别区域的中心坐标
-                    print(f"[CENTER] 识别区域中心坐标: {current_center_coords}")
-
-            last_pressed_key = current_key_found
-            last_key_time = current_time
-
-    # --- 每2秒定时打印坐标 ---
-    if time.ticks_diff(current_time, last_print_time) >= COORD_PRINT_INTERVAL:
-        if last_center_coords:
-            print(f"[定时] 中心坐标: {last_center_coords}")
+                    if debug:
+                        img.draw_rectangle(key_rects[idx], color=255, thickness=2)
+
+        # 更新当前中心坐标（即使未识别到按键也更新）
+        if current_center_coords:
+            last_center_coords = current_center_coords
+        elif not blobs:
+            last_center_coords = None  # 没有检测到斑点时，中心坐标为None
+
+        # --- 按键状态机（带去抖处理）---
+        # 同一结果（按键或无按键）需连续出现 DEBOUNCE_FRAMES 帧才生效
+        if current_key_found == candidate_key:
+            if candidate_count < debounce_frames:
+                candidate_count += 1
         else:
-            print("[定时] 未检测到有效按键区域")
-        last_print_time = current_time
+            candidate_key = current_key_found
+            candidate_count = 1
+
+        if candidate_count >= debounce_frames:
+            if current_key_found != last_pressed_key:
+                # 按键状态变化时更新LED
+                led_on() if current_key_found else led_off()
+
+                # 释放与按下命令合并为一次串口写入，调试输出同样合并为一次写入
+                msg = b''
+                log = ""
+                if last_pressed_key:
+                    msg = release[last_pressed_key]
+                    if debug:
+                        log = "[RELEASE] " + last_pressed_key + "\n"
+
+                # 按下命令并打印中心坐标
+                if current_key_found:
+                    msg += press[current_key_found]
+                    if debug:
+                        # 打印识别区域的中心坐标
+                        log += ("[PRESS] " + current_key_found +
+                                "\n[CENTER] 识别区域中心坐标: " + str(current_center_coords) + "\n")
+
+                write(msg)
+                if log:
+                    out(log)
+
+                last_pressed_key = current_key_found
+
+        # --- 每 COORD_PRINT_FRAMES 帧定时打印坐标 ---
+        frame_ctr += 1
+        if frame_ctr >= print_frames:
+            frame_ctr = 0
+            if last_center_coords:
+                print(f"[定时] 中心坐标: {last_center_coords}")
+            else:
+                print("[定时] 未检测到有效按键区域")
+
+        # --- 显示调试信息 ---
+        # 仅在FPS整数部分、按键或中心坐标变化时重新生成文字，其余帧复用缓存
+        if debug:
+            fps = int(get_fps())
+            if (fps != shown_fps or last_pressed_key != shown_key or
+                    last_center_coords != shown_center):
+                shown_fps = fps
+                shown_key = last_pressed_key
+                shown_center = last_center_coords
+                key_status = last_pressed_key if last_pressed_key else "None"
+                # 在调试信息中添加中心坐标显示
+                center_info = f"Center: {last_center_coords}" if last_center_coords else "Center: None"
+                debug_info = f"FPS: {shown_fps}\nKey: {key_status}\n{center_info}"
+
+            img.draw_string(5, 5, debug_info, color=255, scale=1)
 
-    # --- 显示调试信息 ---
-    fps = clock.fps()
-    key_status = last_pressed_key if last_pressed_key else "None"
-    # 在调试信息中添加中心坐标显示
-    center_info = f"Center: {last_center_coords}" if last_center_coords else "Center: None"
-    debug_info = f"FPS: {fps:.1f}\nKey: {key_status}\n{center_info}"
+        # 无斑点且无按键按住（无人操作）时才让出CPU；有输入时由 snapshot() 按帧节拍驱动
+        if not blobs and current_key_found is None:
+            sleep_ms(idle_ms)
 
-    img.draw_string(5, 5, debug_info, color=255, scale=2)
 
-    # 控制CPU占用率
-    time.sleep_ms(10)
+main()
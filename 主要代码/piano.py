@@ -5,6 +5,9 @@ import sensor
 import image
 import time
 import pyb
+import sys
+import micropython
+import array
 
 # --------------------------------------------------------------------
 # 钢琴键映射表 (Piano Keymap Data)
@@ -52,31 +55,98 @@ black_keys = [
 # 将黑键放在前面，因为它们在视觉上位于上层。
 # 当手指按在黑键和白键的重叠区域时，优先检测为黑键。
 pianokey_map_data = black_keys + white_keys
-
+CALIB_W, CALIB_H = 320, 240 # 以上坐标对应的图像尺寸（QVGA）
 
 # ====================================================================
-# --- 第2部分：主程序逻辑 (与原代码完全相同) ---
+# --- 第2部分：主程序逻辑 ---
 # ====================================================================
 
 # --- 配置 ---
 BLOB_THRESHOLD = (5, 255) # 根据你的实际红外环境调整此阈值
+CALIB_MIN_BLOB_PIXELS = 50 # 校准尺寸下的最小斑点像素数（按追踪分辨率自动换算）
+IDLE_SLEEP_MS = 20 # 无斑点时的空闲休眠(ms)
 
 # --- 初始化摄像头 ---
 sensor.reset()
 sensor.set_pixformat(sensor.GRAYSCALE)
-sensor.set_framesize(sensor.QVGA) # 320x240
+sensor.set_framesize(sensor.QQVGA) # 160x120
 sensor.skip_frames(time=2000)
 # 固定曝光和增益对稳定识别至关重要
 sensor.set_auto_gain(False, gain_db=10)
 sensor.set_auto_exposure(False, exposure_us=1000)
 
+# --- 预计算像素->琴键查找表（LUT）---
+# 每个像素存放琴键索引，0xFF表示不在任何琴键内。
+# 倒序填充：先画白键，再由黑键覆盖，保持黑键优先；只填充矩形内部像素。
+# 映射数据按 CALIB_W x CALIB_H 的图像校准；帧尺寸取自 set_framesize 的实际结果，
+# 加载时坐标除以 KEYMAP_SCALE 换算到追踪分辨率（只支持宽高同比例的整数倍缩小）
+IMG_W, IMG_H = sensor.width(), sensor.height()
+assert (IMG_W <= CALIB_W and CALIB_W % IMG_W == 0 and CALIB_H % IMG_H == 0 and
+        CALIB_W // IMG_W == CALIB_H // IMG_H), "帧尺寸必须是校准尺寸的整数倍缩小"
+KEYMAP_SCALE = CALIB_W // IMG_W
+# 斑点面积随缩放比例的平方缩小（QQVGA 下为 50 // 4 = 12）
+MIN_BLOB_PIXELS = CALIB_MIN_BLOB_PIXELS // (KEYMAP_SCALE * KEYMAP_SCALE)
+# 琴键数据转为并行元组（结构数组），避免运行时的字典查找
+keys = tuple(k['key'] for k in pianokey_map_data)
+rects = tuple(tuple(v // KEYMAP_SCALE for v in k['rect']) for k in pianokey_map_data)
+key_x0 = tuple(r[0] for r in rects)
+key_y0 = tuple(r[1] for r in rects)
+key_x1 = tuple(r[0] + r[2] for r in rects)
+key_y1 = tuple(r[1] + r[3] for r in rects)
+
+# 所有按键矩形的外接框（限制在图像范围内）：框外的坐标直接判定为未命中
+BB_X0 = max(min(key_x0), 0)
+BB_Y0 = max(min(key_y0), 0)
+BB_X1 = min(max(key_x1), IMG_W)
+BB_Y1 = min(max(key_y1), IMG_H)
+LUT_W = BB_X1 - BB_X0
+LUT_H = BB_Y1 - BB_Y0
+
+# 查找表只覆盖外接框，坐标需减去 (BB_X0, BB_Y0)
+key_lut = bytearray(b'\xff' * (LUT_W * LUT_H))
+for i in range(len(keys) - 1, -1, -1):
+    xs, xe = max(key_x0[i] + 1, BB_X0), min(key_x1[i], BB_X1)
+    if xs >= xe:
+        continue
+    row = bytes([i]) * (xe - xs)
+    for yy in range(max(key_y0[i] + 1, BB_Y0), min(key_y1[i], BB_Y1)):
+        base = (yy - BB_Y0) * LUT_W - BB_X0
+        key_lut[base + xs:base + xe] = row
+
+# 外接框参数，供 viper 函数以 ptr16 读取：(x0, y0, 宽, 高)
+key_geom = array.array('H', (BB_X0, BB_Y0, LUT_W, LUT_H))
+
+
+@micropython.viper
+def hit_test(cx: int, cy: int, lut: ptr8, geom: ptr16) -> int:
+    # 编译为本地机器码：外接框检查 + 查表，返回按键索引，0xFF 表示未命中
+    x = cx - geom[0]
+    y = cy - geom[1]
+    w = geom[2]
+    if x < 0 or y < 0 or x >= w or y >= geom[3]:
+        return 0xFF
+    return lut[y * w + x]
+
+# --- 斑点检测区域：同一外接框 ---
+KEYMAP_ROI = (BB_X0, BB_Y0, LUT_W, LUT_H)
+
+# --- 预编码串口指令：'D' for Down (Note On)，'U' for Up (Note Off) ---
+press_cmds = {k: ('D_' + k + '\n').encode() for k in keys}
+release_cmds = {k: ('U_' + k + '\n').encode() for k in keys}
+
+# --- 按住状态下的快速检测：琴键名 -> 索引 ---
+key_index = {k: i for i, k in enumerate(keys)}
+# 矩形内部（去掉边界一圈）须能容纳边长为 sqrt(MIN_BLOB_PIXELS) 的方形斑点，否则手指斑点
+# 几乎总会触边，快速检测必然失败而多扫一次；这类过小的琴键直接走整帧检测
+can_shortcut = tuple(max(min(r[2], r[3]) - 2, 0) ** 2 >= MIN_BLOB_PIXELS for r in rects)
+
 # --- 初始化与RT-Thread主控通信的串口 ---
 # 在RT-Thread Vision Board上，OpenMV通过其UART(9)与主控的uart4连接
 uart_to_mcu = pyb.UART(9, 115200)
 
-# --- 状态变量 ---
-last_pressed_key = None
+# --- 硬件与调试 ---
 led_blue = pyb.LED(3)
+debug_mode = False # 调试模式开关：开启后在图像上绘制斑点、琴键和FPS
 
 # 调试信息用的时钟，用于计算帧率FPS
 clock = time.clock()
@@ -85,58 +155,135 @@ print("--- Virtual Piano Script ---")
 print("All code is running from RAM.")
 print("Piano keymap data has been loaded internally.")
 
-# --- 主循环 ---
-while True:
-    clock.tick() # 更新时钟
-    img = sensor.snapshot()
-
-    blobs = img.find_blobs([BLOB_THRESHOLD], pixels_threshold=50, area_threshold=50, merge=True)
-
-    current_key_found = None
-
-    if blobs:
-        main_blob = max(blobs, key=lambda b: b.pixels())
-        cx = main_blob.cx()
-        cy = main_blob.cy()
-
-        # 在屏幕上绘制检测到的斑点
-        img.draw_rectangle(main_blob.rect(), color=128)
-        img.draw_cross(cx, cy, color=128)
-
-        # 遍历校准好的钢琴键映射表
-        for key_info in pianokey_map_data:
-            key_rect = key_info["rect"]
-            if (cx > key_rect[0] and cx < key_rect[0] + key_rect[2] and
-                cy > key_rect[1] and cy < key_rect[1] + key_rect[3]):
-
-                # 这里假设所有定义的琴键都是有效的，不像键盘有'NULL'键
-                current_key_found = key_info["key"]
-                # 高亮显示被按下的键
-                img.draw_rectangle(key_rect, color=200, thickness=2)
-                break
-
-    # --- 状态机与串口发送逻辑 ---
-    if current_key_found != last_pressed_key:
-        led_blue.on() if current_key_found else led_blue.off()
-
-        if last_pressed_key:
-            # 发送音符关闭 (Note Off) 指令
-            release_command = f"U_{last_pressed_key}\n" # 'U' for Up
-            uart_to_mcu.write(release_command)
-            print(f"Note Released: {last_pressed_key}, Sent: {release_command.strip()}")
-
-        if current_key_found:
-            # 发送音符开启 (Note On) 指令
-            press_command = f"D_{current_key_found}\n" # 'D' for Down
-            uart_to_mcu.write(press_command)
-            print(f"Note Pressed:  {current_key_found}, Sent: {press_command.strip()}")
-
-        last_pressed_key = current_key_found
-
-    # 在屏幕左上角显示帧率(FPS)和当前按下的音符
-    fps = clock.fps()
-    display_text = f"FPS: {fps:.2f}\nNote: {last_pressed_key if last_pressed_key else 'None'}"
-    img.draw_string(5, 5, display_text, color=255, scale=2, mono_space=False)
-
-    # 延时以降低CPU占用率
-    time.sleep_ms(30)
+
+def main():
+    # 循环中频繁使用的全局对象/方法绑定为局部变量，避免每帧的全局字典查找
+    snapshot = sensor.snapshot
+    tick = clock.tick
+    write = uart_to_mcu.write
+    out = sys.stdout.write
+    lut = key_lut
+    key_names = keys
+    thresholds = [BLOB_THRESHOLD]
+    roi = KEYMAP_ROI
+    find_key = hit_test
+    geom = key_geom
+    key_rects = rects
+    index_of = key_index
+    shortcut_ok = can_shortcut
+    press = press_cmds
+    release = release_cmds
+    led_on = led_blue.on
+    led_off = led_blue.off
+    get_fps = clock.fps
+    sleep_ms = time.sleep_ms
+    min_pixels = MIN_BLOB_PIXELS
+    idle_ms = IDLE_SLEEP_MS
+    debug = debug_mode
+
+    # --- 状态变量 ---
+    last_pressed_key = None
+    shown_fps = -1 # 显示文字缓存对应的FPS（取整）
+    shown_key = None # 显示文字缓存对应的音符
+    display_text = "" # 缓存的显示文字
+
+    # --- 主循环 ---
+    while True:
+        tick() # 更新时钟
+        img = snapshot()
+
+        current_key_found = None
+        blobs = None
+
+        # 已有琴键按住时，先只在该琴键矩形内按与按下相同的条件查找斑点：
+        # 仅有一个斑点、完全位于矩形内部（未被矩形边界截断）且质心仍映射到该琴键时，
+        # 视为继续按住并跳过整帧斑点检测；否则回退到整帧检测（处理释放和换键）
+        held = False
+        if last_pressed_key is not None:
+            held_idx = index_of[last_pressed_key]
+            if shortcut_ok[held_idx]:
+                hx, hy, hw, hh = key_rects[held_idx]
+                held_blobs = img.find_blobs(thresholds,
+                                            roi=key_rects[held_idx],
+                                            pixels_threshold=min_pixels,
+                                            area_threshold=min_pixels)
+                if len(held_blobs) == 1:
+                    hb = held_blobs[0]
+                    bx, by, bw, bh = hb.rect()
+                    held = (bx > hx and by > hy and bx + bw < hx + hw and by + bh < hy + hh and
+                            find_key(hb.cx(), hb.cy(), lut, geom) == held_idx)
+
+        if held:
+            current_key_found = last_pressed_key
+            if debug:
+                img.draw_rectangle(key_rects[held_idx], color=200, thickness=2)
+        else:
+            # 只跟踪最大的斑点，不需要 merge 合并
+            blobs = img.find_blobs(thresholds, roi=roi, pixels_threshold=min_pixels, area_threshold=min_pixels)
+
+            if blobs:
+                # 选择最大的斑点（通常只有一个斑点，直接取用）
+                main_blob = blobs[0]
+                if len(blobs) > 1:
+                    best = main_blob.pixels()
+                    for b in blobs[1:]:
+                        p = b.pixels()
+                        if p > best:
+                            best = p
+                            main_blob = b
+                cx = main_blob.cx()
+                cy = main_blob.cy()
+
+                # 在屏幕上绘制检测到的斑点
+                if debug:
+                    rect_bb = main_blob.rect()
+                    img.draw_rectangle(rect_bb, color=128)
+                    img.draw_cross(cx, cy, color=128)
+
+                # 外接框检查与查表在 viper 本地代码中完成
+                idx = find_key(cx, cy, lut, geom)
+                if idx != 0xFF:
+                    # 这里假设所有定义的琴键都是有效的，不像键盘有'NULL'键
+                    current_key_found = key_names[idx]
+                    # 高亮显示被按下的键
+                    if debug:
+                        img.draw_rectangle(key_rects[idx], color=200, thickness=2)
+
+        # --- 状态机与串口发送逻辑 ---
+        if current_key_found != last_pressed_key:
+            led_on() if current_key_found else led_off()
+
+            # 音符关闭与开启指令合并为一次串口写入，日志同样合并为一次输出
+            msg = b''
+            log = ""
+            if last_pressed_key:
+                # 音符关闭 (Note Off) 指令
+                msg = release[last_pressed_key]
+                log = "Note Released: " + last_pressed_key + ", Sent: U_" + last_pressed_key + "\n"
+
+            if current_key_found:
+                # 音符开启 (Note On) 指令
+                msg += press[current_key_found]
+                log += "Note Pressed:  " + current_key_found + ", Sent: D_" + current_key_found + "\n"
+
+            write(msg)
+            out(log)
+
+            last_pressed_key = current_key_found
+
+        # 在屏幕左上角显示帧率(FPS)和当前按下的音符
+        # 仅在FPS整数部分或音符变化时重新生成文字，其余帧复用缓存
+        if debug:
+            fps = int(get_fps())
+            if fps != shown_fps or last_pressed_key != shown_key:
+                shown_fps = fps
+                shown_key = last_pressed_key
+                display_text = f"FPS: {shown_fps}\nNote: {last_pressed_key if last_pressed_key else 'None'}"
+            img.draw_string(5, 5, display_text, color=255, scale=1, mono_space=False)
+
+        # 无斑点且无按键按住（无人操作）时才让出CPU；有输入时由 snapshot() 按帧节拍驱动
+        if not blobs and current_key_found is None:
+            sleep_ms(idle_ms)
+
+
+main()